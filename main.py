@@ -11,8 +11,10 @@ This script orchestrates the entire data pipeline:
 """
 
 import os
+import hashlib
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import psycopg2
 
@@ -21,7 +23,7 @@ from scripts.data_acquisition import acquire_data
 from scripts.data_processing import process_data
 from scripts.customer_segmentation import perform_rfm_analysis
 from scripts.sales_analysis import analyze_sales
-from scripts.db_utils import connect_to_database, execute_sql_file, execute_query
+from scripts.db_utils import connect_to_database, close_connection, execute_sql_file, execute_query
 import config
 
 # Create necessary directories first
@@ -53,52 +55,103 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def check_tables_exist(conn):
+def check_database_state(conn):
     """
-    Check if the database tables already exist.
-    
+    Check whether the database tables exist and already hold data.
+
     Args:
         conn: Database connection
-        
+
     Returns:
-        True if tables exist, False otherwise
+        Tuple of (tables_exist, data_exists)
     """
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT to_regclass('customers')")
-        result = cursor.fetchone()[0]
+
+        # to_regclass never errors on missing tables, so this probe is safe
+        # to run against any database state
+        cursor.execute("""
+        SELECT
+            to_regclass('customers') IS NOT NULL,
+            to_regclass('products') IS NOT NULL,
+            to_regclass('orders') IS NOT NULL
+        """)
+        tables_exist = all(cursor.fetchone())
+
+        # Only query the tables themselves once all three are known to
+        # exist - an EXISTS probe against a missing table would error out
+        # and misreport the surviving tables as absent
+        data_exists = False
+        if tables_exist:
+            cursor.execute("""
+            SELECT
+                EXISTS (SELECT 1 FROM customers),
+                EXISTS (SELECT 1 FROM products),
+                EXISTS (SELECT 1 FROM orders)
+            """)
+            row = cursor.fetchone()
+            # Consider the database populated only if all three main tables have data
+            data_exists = bool(row[0] and row[1] and row[2])
+
         cursor.close()
-        return result is not None
-    except Exception:
-        return False
+        return tables_exist, data_exists
+    except Exception as e:
+        logger.warning(f"Error checking database state: {str(e)}")
+        conn.rollback()
+        return False, False
 
-def check_data_exists(conn):
+def execute_sql_file_if_changed(conn, file_path, process_name):
     """
-    Check if data already exists in the database.
-    
+    Execute an idempotent DDL file only if its contents changed since the
+    last run.
+
+    The digest of the file is recorded in data_processing_log (with a
+    DIGEST: prefix so it can't collide with STARTED/COMPLETED statuses) and
+    repeat pipeline runs skip re-parsing and re-executing unchanged DDL.
+    Only safe for files whose skip is harmless - e.g. CREATE OR REPLACE
+    views - not for schema files whose objects may have been dropped since
+    the digest was recorded.
+
     Args:
         conn: Database connection
-        
-    Returns:
-        True if data exists, False otherwise
+        file_path: Path to the SQL file
+        process_name: Log entry name used to track the file's digest
     """
+    with open(file_path, 'rb') as f:
+        digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    digest_status = f"DIGEST:{digest}"
+
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM customers")
-        customer_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM products")
-        product_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM orders")
-        order_count = cursor.fetchone()[0]
+        cursor.execute("""
+        SELECT 1 FROM data_processing_log
+        WHERE process_name = %s AND status = %s
+        LIMIT 1
+        """, (process_name, digest_status))
+        unchanged = cursor.fetchone() is not None
+        cursor.close()
+    except Exception:
+        # Log table may not exist yet (first run)
+        conn.rollback()
+        unchanged = False
+
+    if unchanged:
+        logger.info(f"Skipping {file_path} - contents unchanged since last run")
+        return
+
+    execute_sql_file(conn, file_path)
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+        INSERT INTO data_processing_log (process_name, end_time, status)
+        VALUES (%s, CURRENT_TIMESTAMP, %s)
+        """, (process_name, digest_status))
+        conn.commit()
         cursor.close()
-        
-        # If we have data in all three main tables, consider it populated
-        if customer_count > 0 and product_count > 0 and order_count > 0:
-            return True
-        return False
     except Exception as e:
-        logger.warning(f"Error checking if data exists: {str(e)}")
-        return False
+        logger.warning(f"Could not record DDL digest for {file_path}: {str(e)}")
+        conn.rollback()
 
 def run_pipeline(steps=None, force_update=False):
     """
@@ -119,14 +172,15 @@ def run_pipeline(steps=None, force_update=False):
     data_exists = False
     if "database" in steps:
         conn = connect_to_database(config.DB_CONFIG)
-        tables_exist = check_tables_exist(conn)
-        
-        if tables_exist:
-            data_exists = check_data_exists(conn)
-            if data_exists and not force_update:
-                logger.info("Data already exists in the database. Use --force to reprocess.")
-            
-        conn.close()
+        # Lightweight probe - autocommit skips the implicit BEGIN/COMMIT pair
+        conn.autocommit = True
+        tables_exist, data_exists = check_database_state(conn)
+
+        if data_exists and not force_update:
+            logger.info("Data already exists in the database. Use --force to reprocess.")
+
+        conn.autocommit = False
+        close_connection(conn)
     
     # Step 1: Data Acquisition
     if "acquisition" in steps and (not data_exists or force_update):
@@ -143,13 +197,15 @@ def run_pipeline(steps=None, force_update=False):
     if "database" in steps:
         logger.info("Step 2: Database Setup")
         conn = connect_to_database(config.DB_CONFIG)
-        
+
         # Check if tables already exist
-        tables_exist = check_tables_exist(conn)
-        
+        tables_exist, _ = check_database_state(conn)
+
         if not tables_exist:
             logger.info("Tables don't exist. Creating database schema...")
-            # Create tables
+            # Create tables unconditionally - a digest skip here would be
+            # unsound, since the probe just told us the tables are missing
+            # even if the DDL file itself hasn't changed
             execute_sql_file(conn, "database/create_tables.sql")
             logger.info("Database tables created")
         else:
@@ -170,10 +226,10 @@ def run_pipeline(steps=None, force_update=False):
         
         # Create analysis views
         logger.info("Creating or updating analysis views...")
-        execute_sql_file(conn, "database/analysis_views.sql")
+        execute_sql_file_if_changed(conn, "database/analysis_views.sql", "views_ddl")
         logger.info("Analysis views created or updated")
         
-        conn.close()
+        close_connection(conn)
     
     # Step 3: Data Processing
     if "processing" in steps and (not data_exists or force_update):
@@ -187,27 +243,38 @@ def run_pipeline(steps=None, force_update=False):
     elif "processing" in steps and data_exists and not force_update:
         logger.info("Skipping data processing - data already exists")
     
-    # Step 4: RFM Analysis
-    if "rfm" in steps and (not data_exists or force_update):
-        logger.info("Step 4: Customer Segmentation (RFM Analysis)")
-        perform_rfm_analysis(
-            db_config=config.DB_CONFIG,
-            output_dir=config.PROCESSED_DATA_DIR
-        )
-        logger.info("RFM analysis completed")
-    elif "rfm" in steps and data_exists and not force_update:
-        logger.info("Skipping RFM analysis - data already exists")
-    
-    # Step 5: Sales Analysis
-    if "sales" in steps and (not data_exists or force_update):
-        logger.info("Step 5: Sales Analysis")
-        analyze_sales(
-            db_config=config.DB_CONFIG,
-            output_dir=config.PROCESSED_DATA_DIR
-        )
-        logger.info("Sales analysis completed")
-    elif "sales" in steps and data_exists and not force_update:
-        logger.info("Skipping sales analysis - data already exists")
+    # Steps 4 & 5: the sales analysis is not independent of RFM -
+    # vw_segment_performance joins customer_segments, which the RFM step
+    # deletes and rewrites - so whenever both are scheduled the sales
+    # analysis waits for RFM to commit before it starts (its own four
+    # queries still run concurrently internally)
+    analysis_steps = [s for s in ("rfm", "sales") if s in steps]
+    if analysis_steps and (not data_exists or force_update):
+        logger.info(f"Steps 4-5: Running analysis steps: {', '.join(analysis_steps)}")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = {}
+            rfm_future = None
+            if "rfm" in analysis_steps:
+                rfm_future = executor.submit(
+                    perform_rfm_analysis,
+                    db_config=config.DB_CONFIG,
+                    output_dir=config.PROCESSED_DATA_DIR
+                )
+                futures["RFM analysis"] = rfm_future
+            if "sales" in analysis_steps:
+                def _sales_after_rfm():
+                    if rfm_future is not None:
+                        rfm_future.result()
+                    return analyze_sales(
+                        db_config=config.DB_CONFIG,
+                        output_dir=config.PROCESSED_DATA_DIR
+                    )
+                futures["Sales analysis"] = executor.submit(_sales_after_rfm)
+            for step_name, future in futures.items():
+                future.result()
+                logger.info(f"{step_name} completed")
+    elif analysis_steps and data_exists and not force_update:
+        logger.info("Skipping RFM and sales analysis - data already exists")
     
     # Update processing log
     if "database" in steps:
@@ -221,7 +288,7 @@ def run_pipeline(steps=None, force_update=False):
             """)
             conn.commit()
             cursor.close()
-            conn.close()
+            close_connection(conn)
         except Exception as e:
             logger.warning(f"Could not update processing log entry: {str(e)}")
     
@@ -3,103 +3,72 @@ import logging
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scripts.db_utils import connect_to_database, execute_query, execute_many
+from scripts.db_utils import connect_to_database, close_connection, copy_dataframe, execute_query
+from scripts.io_utils import write_csv
 
 
 logger = logging.getLogger(__name__)
 
+def _quantile_score(values, reverse=False):
+    edges = np.quantile(values, [0.2, 0.4, 0.6, 0.8])
+    scores = (np.searchsorted(edges, values, side='right') + 1).astype(np.int8)
+    return (6 - scores).astype(np.int8) if reverse else scores
+
 def calculate_rfm_scores(customers_df):
     logger.info("Calculating RFM scores")
     
     rfm_df = customers_df.copy()
     
-    if isinstance(rfm_df['last_purchase_date'].iloc[0], str):
-        rfm_df['last_purchase_date'] = pd.to_datetime(rfm_df['last_purchase_date'])
-    if isinstance(rfm_df['first_purchase_date'].iloc[0], str):
-        rfm_df['first_purchase_date'] = pd.to_datetime(rfm_df['first_purchase_date'])
-    
-    current_date = datetime.now().date()
-    rfm_df['recency_days'] = (pd.to_datetime(current_date) - pd.to_datetime(rfm_df['last_purchase_date'])).dt.days
-    
+    rfm_df['last_purchase_date'] = pd.to_datetime(rfm_df['last_purchase_date'], errors='coerce')
+    rfm_df['first_purchase_date'] = pd.to_datetime(rfm_df['first_purchase_date'], errors='coerce')
 
-    try:
-        rfm_df['recency_score'] = pd.qcut(
-            rfm_df['recency_days'], 
-            q=5,
-            labels=[5, 4, 3, 2, 1],
-            duplicates='drop'
-        )
-    except ValueError:
-        rfm_df['recency_score'] = pd.cut(
-            rfm_df['recency_days'],
-            bins=[0, 7, 30, 90, 180, float('inf')],
-            labels=[5, 4, 3, 2, 1],
-            include_lowest=True
-        )
-    
-    try:
-        rfm_df['frequency_score'] = pd.qcut(
-            rfm_df['total_purchases'].clip(lower=1),
-            q=5,
-            labels=[1, 2, 3, 4, 5],
-            duplicates='drop'
-        )
-    except ValueError:
-        rfm_df['frequency_score'] = pd.cut(
-            rfm_df['total_purchases'].clip(lower=1),
-            bins=[0, 1, 2, 5, 10, float('inf')],
-            labels=[1, 2, 3, 4, 5],
-            include_lowest=True
-        )
-    
-    try:
-        rfm_df['monetary_score'] = pd.qcut(
-            rfm_df['total_spent'].clip(lower=0.01),
-            q=5,
-            labels=[1, 2, 3, 4, 5],
-            duplicates='drop'
-        )
-    except ValueError:
-        rfm_df['monetary_score'] = pd.cut(
-            rfm_df['total_spent'].clip(lower=0.01),
-            bins=[0, 10, 50, 100, 500, float('inf')],
-            labels=[1, 2, 3, 4, 5],
-            include_lowest=True
-        )
-
-    for col in ['recency_score', 'frequency_score', 'monetary_score']:
-        rfm_df[col] = rfm_df[col].astype(int)
-    
-    rfm_df['rfm_score'] = rfm_df['recency_score'] + rfm_df['frequency_score'] + rfm_df['monetary_score']
-    
-    def assign_segment(row):
-        r, f, m = row['recency_score'], row['frequency_score'], row['monetary_score']
-        rfm = row['rfm_score']
-        
-        if rfm >= 13:
-            return 'Champions'
-        elif r >= 4 and (f >= 4 or m >= 4):
-            return 'Loyal Customers'
-        elif (r >= 3) and (f >= 3 and m >= 3):
-            return 'Potential Loyalists'
-        elif (r >= 4) and (f <= 2 and m <= 2):
-            return 'New Customers'
-        elif (r >= 3) and (f <= 2 and m <= 2):
-            return 'Promising'
-        elif (r <= 2) and (f >= 4 and m >= 4):
-            return 'At Risk'
-        elif (r <= 2) and (f >= 3 and m >= 3):
-            return 'Need Attention'
-        elif (r <= 2) and (f <= 2 and m >= 3):
-            return 'About to Sleep'
-        elif (r <= 2) and (f <= 2 and m <= 2):
-            return 'Hibernating'
-        else:
-            return 'Cannot Lose'
+    today = np.datetime64(datetime.now().date())
+    recency = (today - rfm_df['last_purchase_date'].to_numpy()) / np.timedelta64(1, 'D')
+
+    # Customers with no purchase history (NaT last_purchase_date) would
+    # wrap to INT32_MIN in the cast and score as most recent; pin them
+    # just past the stalest real customer instead
+    missing = np.isnan(recency)
+    if missing.any():
+        recency[missing] = np.nanmax(recency, initial=0.0) + 1
+    rfm_df['recency_days'] = recency.astype('int32')
+
+
+    rfm_df['recency_score'] = _quantile_score(rfm_df['recency_days'].to_numpy(), reverse=True)
+    rfm_df['frequency_score'] = _quantile_score(rfm_df['total_purchases'].clip(lower=1).to_numpy())
+    rfm_df['monetary_score'] = _quantile_score(rfm_df['total_spent'].clip(lower=0.01).to_numpy())
+
+    rfm_df['rfm_score'] = rfm_df[['recency_score', 'frequency_score', 'monetary_score']].to_numpy().sum(axis=1, dtype=np.int8)
     
-    rfm_df['segment'] = rfm_df.apply(assign_segment, axis=1)
+    r = rfm_df['recency_score'].to_numpy()
+    f = rfm_df['frequency_score'].to_numpy()
+    m = rfm_df['monetary_score'].to_numpy()
+    rfm = rfm_df['rfm_score'].to_numpy()
+
+    segment_conditions = [
+        rfm >= 13,
+        (r >= 4) & ((f >= 4) | (m >= 4)),
+        (r >= 3) & (f >= 3) & (m >= 3),
+        (r >= 4) & (f <= 2) & (m <= 2),
+        (r >= 3) & (f <= 2) & (m <= 2),
+        (r <= 2) & (f >= 4) & (m >= 4),
+        (r <= 2) & (f >= 3) & (m >= 3),
+        (r <= 2) & (f <= 2) & (m >= 3),
+        (r <= 2) & (f <= 2) & (m <= 2),
+    ]
+    segment_labels = [
+        'Champions',
+        'Loyal Customers',
+        'Potential Loyalists',
+        'New Customers',
+        'Promising',
+        'At Risk',
+        'Need Attention',
+        'About to Sleep',
+        'Hibernating',
+    ]
+
+    rfm_df['segment'] = np.select(segment_conditions, segment_labels, default='Cannot Lose')
     
     segment_counts = rfm_df['segment'].value_counts()
     logger.info(f"Customer segments created:\n{segment_counts}")
@@ -108,112 +77,133 @@ def calculate_rfm_scores(customers_df):
 
 def save_rfm_analysis(rfm_df, output_dir):
     logger.info(f"Saving RFM analysis results to {output_dir}")
-    
+
     os.makedirs(output_dir, exist_ok=True)
-    
+
     rfm_path = os.path.join(output_dir, "customer_segments.csv")
-    rfm_df.to_csv(rfm_path, index=False)
+    write_csv(rfm_df, rfm_path)
     logger.info(f"Saved RFM data to {rfm_path}")
-    
-    plt.figure(figsize=(12, 6))
+
+    if os.environ.get('SKIP_VIZ'):
+        logger.info("SKIP_VIZ set - skipping RFM visualizations")
+        return rfm_path
+
+    # Imported lazily so DB-only invocations don't pay the import cost
+    import matplotlib
+    if not os.environ.get('DISPLAY'):
+        matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    import seaborn as sns
+
+    # The OO Figure API avoids pyplot's global state, which is not
+    # thread-safe when this runs alongside the sales analysis step
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
     segment_counts = rfm_df['segment'].value_counts()
-    ax = sns.barplot(x=segment_counts.index, y=segment_counts.values)
-    plt.title('Customer Segment Distribution')
-    plt.xticks(rotation=45, ha='right')
-    plt.ylabel('Number of Customers')
-    plt.tight_layout()
+    sns.barplot(x=segment_counts.index, y=segment_counts.values, ax=ax)
+    ax.set_title('Customer Segment Distribution')
+    ax.tick_params(axis='x', rotation=45)
+    ax.set_ylabel('Number of Customers')
+    fig.tight_layout()
 
     viz_path = os.path.join(output_dir, "segment_distribution.png")
-    plt.savefig(viz_path)
+    fig.savefig(viz_path)
     logger.info(f"Saved segment distribution visualization to {viz_path}")
-    
-    plt.figure(figsize=(12, 8))
-    plt.subplot(3, 1, 1)
-    sns.countplot(x='recency_score', data=rfm_df)
-    plt.title('Recency Score Distribution')
-    
-    plt.subplot(3, 1, 2)
-    sns.countplot(x='frequency_score', data=rfm_df)
-    plt.title('Frequency Score Distribution')
-    
-    plt.subplot(3, 1, 3)
-    sns.countplot(x='monetary_score', data=rfm_df)
-    plt.title('Monetary Score Distribution')
-    
-    plt.tight_layout()
+
+    fig = Figure(figsize=(12, 8))
+    axes = fig.subplots(3, 1)
+    sns.countplot(x='recency_score', data=rfm_df, ax=axes[0])
+    axes[0].set_title('Recency Score Distribution')
+
+    sns.countplot(x='frequency_score', data=rfm_df, ax=axes[1])
+    axes[1].set_title('Frequency Score Distribution')
+
+    sns.countplot(x='monetary_score', data=rfm_df, ax=axes[2])
+    axes[2].set_title('Monetary Score Distribution')
+
+    fig.tight_layout()
     rfm_viz_path = os.path.join(output_dir, "rfm_score_distribution.png")
-    plt.savefig(rfm_viz_path)
+    fig.savefig(rfm_viz_path)
     logger.info(f"Saved RFM score distribution visualization to {rfm_viz_path}")
-    plt.close()
     return rfm_path
 
-def load_rfm_to_database(rfm_df, db_config):
+def load_rfm_to_database(rfm_df, conn):
     logger.info("Loading RFM results to database")
-    
-    conn = connect_to_database(db_config)
+
     cursor = conn.cursor()
-    
+
     try:
         conn.autocommit = False
         
         cursor.execute("DELETE FROM customer_segments")
-        
-        rfm_data = [tuple(row) for row in rfm_df.values]
-        
-        query = """
+
+        cursor.execute("""
+        CREATE TEMP TABLE tmp_customer_segments
+            (LIKE customer_segments INCLUDING DEFAULTS)
+        ON COMMIT DROP
+        """)
+
+        copy_dataframe(conn, 'tmp_customer_segments', rfm_df,
+                       columns=['customer_id', 'recency_score', 'frequency_score',
+                                'monetary_score', 'rfm_score', 'segment'])
+
+        cursor.execute("""
         INSERT INTO customer_segments
-            (customer_id, recency_score, frequency_score, monetary_score, rfm_score, segment)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        SELECT * FROM tmp_customer_segments
         ON CONFLICT (customer_id) DO UPDATE SET
             recency_score = EXCLUDED.recency_score,
             frequency_score = EXCLUDED.frequency_score,
             monetary_score = EXCLUDED.monetary_score,
             rfm_score = EXCLUDED.rfm_score,
             segment = EXCLUDED.segment
-        """
-        execute_many(cursor, query, rfm_data)
+        """)
         conn.commit()
-        logger.info(f"Loaded {len(rfm_data)} customer segment records to database")
+        logger.info(f"Loaded {len(rfm_df)} customer segment records to database")
         
     except Exception as e:
         conn.rollback()
         logger.error(f"Error loading RFM data to database: {str(e)}")
         raise
-    
+
     finally:
         cursor.close()
-        conn.close()
 
 def perform_rfm_analysis(db_config=None, output_dir=None):
     logger.info("Starting RFM analysis")
-    
+
     if db_config:
         conn = connect_to_database(db_config)
-        query = """
-        SELECT
-            customer_id, 
-            country, 
-            first_purchase_date, 
-            last_purchase_date, 
-            total_purchases, 
-            total_spent 
-        FROM customers
-        """
-        customers_df = execute_query(conn, query)
-        conn.close()
+        try:
+            query = """
+            SELECT
+                customer_id,
+                country,
+                first_purchase_date,
+                last_purchase_date,
+                total_purchases,
+                total_spent
+            FROM customers
+            """
+            customers_df = execute_query(conn, query)
+
+            rfm_df = calculate_rfm_scores(customers_df)
+
+            if output_dir:
+                save_rfm_analysis(rfm_df, output_dir)
+
+            load_rfm_to_database(rfm_df, conn)
+        finally:
+            close_connection(conn)
     else:
         if output_dir and os.path.exists(os.path.join(output_dir, "customers.csv")):
             customers_df = pd.read_csv(os.path.join(output_dir, "customers.csv"))
         else:
             raise ValueError("Either db_config or valid output_dir with customers.csv must be provided")
-    
-    rfm_df = calculate_rfm_scores(customers_df)
-    
-    if output_dir:
-        save_rfm_analysis(rfm_df, output_dir)
-    
-    if db_config:
-        load_rfm_to_database(rfm_df, db_config)
+
+        rfm_df = calculate_rfm_scores(customers_df)
+
+        if output_dir:
+            save_rfm_analysis(rfm_df, output_dir)
 
     logger.info("RFM analysis completed successfully")
     return rfm_df
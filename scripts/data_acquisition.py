@@ -1,36 +1,173 @@
 import os
+import shutil
 import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter, Retry
+from faker import Faker
+
+from scripts.io_utils import write_csv
 
 logger = logging.getLogger(__name__)
 
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.5)
+))
+
 def download_dataset(url, output_path):
     logger.info(f"Downloading dataset from {url}")
-    
+
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                
+        with _SESSION.get(url, stream=True, timeout=(5, 60)) as response:
+            response.raise_for_status()
+
+            # copyfileobj reads the raw socket stream, which skips requests'
+            # transparent content decoding - flip it back on so gzip/deflate
+            # responses land decoded on disk like iter_content would
+            response.raw.decode_content = True
+            with open(output_path, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=1 << 20)
+
         logger.info(f"Dataset downloaded successfully to {output_path}")
         return output_path
-    
+
     except Exception as e:
         logger.error(f"Error downloading dataset: {str(e)}")
         raise
 
+def _ids(prefix, n, width=5):
+    return np.char.add(prefix, np.char.zfill((np.arange(n) + 1).astype(f'U{width}'), width))
+
+def generate_synthetic_data(output_dir, num_records=10000, num_customers=500,
+                            num_products=100, num_countries=15,
+                            start_date="2022-01-01", end_date="2023-12-31"):
+    logger.info(f"Generating synthetic e-commerce data: {num_records} records")
+
+    fake = Faker()
+    rng = np.random.default_rng()
+
+    unit_prices = np.round(rng.uniform(0.5, 50.0, num_products), 2)
+    products_df = pd.DataFrame({
+        'product_id': _ids('P', num_products),
+        'stock_code': _ids('', num_products),
+        'description': [fake.catch_phrase().upper() for _ in range(num_products)],
+        'unit_price': unit_prices
+    })
+
+    countries = np.array([fake.unique.country() for _ in range(num_countries)])
+    customers_df = pd.DataFrame({
+        'customer_id': _ids('C', num_customers),
+        'country': rng.choice(countries, size=num_customers)
+    })
+
+    start = np.datetime64(start_date)
+    end = np.datetime64(end_date)
+    span_seconds = int((end - start) / np.timedelta64(1, 's'))
+
+    new_order_mask = rng.random(num_records) < 0.25
+    new_order_mask[0] = True
+    order_idx = np.cumsum(new_order_mask) - 1
+    num_orders = int(order_idx[-1]) + 1
+
+    order_ids = _ids('O', num_orders, width=6)
+    order_customer_idx = rng.integers(0, num_customers, num_orders)
+    order_dates = start + rng.integers(0, span_seconds, num_orders).astype('timedelta64[s]')
+
+    product_idx = rng.integers(0, num_products, num_records)
+    quantities = rng.integers(1, 13, num_records)
+    item_unit_prices = unit_prices[product_idx]
+    total_prices = np.round(quantities * item_unit_prices, 2)
+
+    order_totals = np.zeros(num_orders)
+    np.add.at(order_totals, order_idx, total_prices)
+
+    orders_df = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customers_df['customer_id'].to_numpy()[order_customer_idx],
+        'order_date': order_dates.astype('datetime64[ns]'),
+        'country': customers_df['country'].to_numpy()[order_customer_idx],
+        'total_amount': np.round(order_totals, 2)
+    })
+
+    order_items_df = pd.DataFrame({
+        'order_id': order_ids[order_idx],
+        'product_id': products_df['product_id'].to_numpy()[product_idx],
+        'quantity': quantities,
+        'unit_price': item_unit_prices,
+        'total_price': total_prices
+    })
+
+    sort_idx = np.argsort(order_customer_idx, kind='stable')
+    cust_sorted = order_customer_idx[sort_idx]
+    dates_sorted = order_dates.astype('datetime64[ns]')[sort_idx]
+    amounts_sorted = np.round(order_totals, 2)[sort_idx]
+
+    uniq_idx, starts, counts = np.unique(cust_sorted, return_index=True, return_counts=True)
+
+    first_purchase = np.full(num_customers, np.datetime64('NaT'), dtype='datetime64[ns]')
+    last_purchase = np.full(num_customers, np.datetime64('NaT'), dtype='datetime64[ns]')
+    total_purchases = np.zeros(num_customers, dtype='int64')
+    total_spent = np.zeros(num_customers)
+
+    first_purchase[uniq_idx] = np.minimum.reduceat(dates_sorted, starts)
+    last_purchase[uniq_idx] = np.maximum.reduceat(dates_sorted, starts)
+    total_purchases[uniq_idx] = counts
+    total_spent[uniq_idx] = np.add.reduceat(amounts_sorted, starts)
+
+    customers_df['first_purchase_date'] = first_purchase
+    customers_df['last_purchase_date'] = last_purchase
+    customers_df['total_purchases'] = total_purchases
+    customers_df['total_spent'] = np.round(total_spent, 2)
+
+    combined_df = (
+        order_items_df
+        .merge(orders_df[['order_id', 'customer_id', 'order_date', 'country']], on='order_id')
+        .merge(products_df[['product_id', 'stock_code', 'description']], on='product_id')
+        .rename(columns={
+            'order_id': 'InvoiceNo',
+            'stock_code': 'StockCode',
+            'description': 'Description',
+            'quantity': 'Quantity',
+            'order_date': 'InvoiceDate',
+            'unit_price': 'UnitPrice',
+            'customer_id': 'CustomerID',
+            'country': 'Country'
+        })
+    )
+    combined_df = combined_df[['InvoiceNo', 'StockCode', 'Description', 'Quantity',
+                               'InvoiceDate', 'UnitPrice', 'CustomerID', 'Country']]
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    write_csv(products_df, os.path.join(output_dir, "products.csv"))
+    write_csv(customers_df, os.path.join(output_dir, "customers.csv"))
+    write_csv(orders_df, os.path.join(output_dir, "orders.csv"))
+    write_csv(order_items_df, os.path.join(output_dir, "order_items.csv"))
+
+    output_path = os.path.join(output_dir, "online_retail_synthetic.csv")
+    write_csv(combined_df, output_path)
+
+    logger.info(f"Generated {len(combined_df)} transaction records "
+                f"({len(orders_df)} orders, {len(customers_df)} customers, {len(products_df)} products)")
+    logger.info(f"Synthetic dataset saved to {output_path}")
+    return output_path
+
 def acquire_data(output_dir, dataset_url=None):
     os.makedirs(output_dir, exist_ok=True)
-    
+
     if not dataset_url:
-        raise ValueError("Dataset URL must be provided")
-    
+        logger.info("No dataset URL provided - falling back to synthetic data generation")
+        return generate_synthetic_data(output_dir)
+
     file_ext = dataset_url.split('.')[-1].lower()
     output_path = os.path.join(output_dir, f"online_retail.{file_ext}")
-    
+
     return download_dataset(dataset_url, output_path)
 
 if __name__ == "__main__":
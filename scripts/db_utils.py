@@ -1,34 +1,171 @@
 import os
+import io
 import logging
+import uuid
+import weakref
 import psycopg2
+from psycopg2 import extras, pool
+import numpy as np
 import pandas as pd
-import re
+import sqlparse
 
 logger = logging.getLogger(__name__)
 
+# One pool per distinct configuration, plus a map from each checked-out
+# connection back to its owning pool so close_connection can return it
+_connection_pools = {}
+_conn_owner = weakref.WeakKeyDictionary()
+
+def _get_pool(db_config):
+    key = tuple(sorted(db_config.items()))
+    if key not in _connection_pools:
+        logger.info(f"Creating connection pool for database: {db_config['database']}")
+        _connection_pools[key] = pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=5,
+            connect_timeout=2,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3,
+            **db_config
+        )
+    return _connection_pools[key]
+
 def connect_to_database(db_config):
     try:
         logger.info(f"Connecting to PostgreSQL database: {db_config['database']}")
-        conn = psycopg2.connect(**db_config)
+        conn_pool = _get_pool(db_config)
+        conn = conn_pool.getconn()
+        _conn_owner[conn] = conn_pool
         return conn
     except Exception as e:
         logger.error(f"Error connecting to PostgreSQL database: {str(e)}")
         raise
 
-def execute_query(conn, query, params=None):
+# PostgreSQL type OIDs that map cleanly onto numpy dtypes, letting numeric
+# result columns bypass the one-Python-object-per-cell construction path
+_NUMERIC_OID_DTYPES = {
+    20: 'int64', 21: 'int64', 23: 'int64',            # int8 / int2 / int4
+    700: 'float64', 701: 'float64', 1700: 'float64',  # float4 / float8 / numeric
+}
+
+def _frame_from_cursor(cursor):
+    """Build a DataFrame column-major from a finished cursor, typing
+    numeric columns straight from the wire metadata."""
+    rows = cursor.fetchall()
+    columns = [d[0] for d in cursor.description]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    data = {}
+    for name, desc, values in zip(columns, cursor.description, zip(*rows)):
+        dtype = _NUMERIC_OID_DTYPES.get(desc[1])
+        if dtype is not None and not any(v is None for v in values):
+            data[name] = np.asarray(values, dtype=dtype)
+        else:
+            data[name] = list(values)
+    return pd.DataFrame(data)
+
+# Per-connection cache of PREPAREd statements so repeated parameterless
+# queries (the analysis SELECTs) skip the server's parse+plan step
+_prepared_statements = weakref.WeakKeyDictionary()
+
+def _execute_prepared(conn, query):
+    cache = _prepared_statements.setdefault(conn, {})
+    cursor = conn.cursor()
     try:
-        return pd.read_sql_query(query, conn, params=params)
+        name = cache.get(query)
+        if name is None:
+            name = f"eq_{len(cache)}"
+            cursor.execute(f"PREPARE {name} AS {query}")
+            cache[query] = name
+        try:
+            cursor.execute(f"EXECUTE {name}")
+        except psycopg2.errors.InvalidSqlStatementName:
+            # The PREPARE was lost to a rolled-back transaction
+            conn.rollback()
+            cursor.execute(f"PREPARE {name} AS {query}")
+            cursor.execute(f"EXECUTE {name}")
+        return _frame_from_cursor(cursor)
+    finally:
+        cursor.close()
+
+def execute_query(conn, query, params=None, chunksize=None):
+    try:
+        if chunksize is None:
+            if params is None:
+                return _execute_prepared(conn, query)
+            # Parameterized queries would need %s-to-$n translation to
+            # prepare, but still take the raw DBAPI path - read_sql_query
+            # warns on plain connections and routes through slower
+            # SQLAlchemy introspection first
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params)
+                return _frame_from_cursor(cursor)
+            finally:
+                cursor.close()
+
+        # A named (server-side) cursor streams the result in chunks, so
+        # large result sets are never materialized twice client-side.
+        # Columns are accumulated column-major to feed DataFrame directly.
+        cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cursor.itersize = chunksize
+        try:
+            cursor.execute(query, params)
+            columns = None
+            col_data = None
+            while True:
+                batch = cursor.fetchmany(chunksize)
+                if columns is None:
+                    columns = [d[0] for d in cursor.description]
+                    col_data = [[] for _ in columns]
+                if not batch:
+                    break
+                for col_list, values in zip(col_data, zip(*batch)):
+                    col_list.extend(values)
+            return pd.DataFrame(dict(zip(columns, col_data)))
+        finally:
+            cursor.close()
     except Exception as e:
         logger.error(f"Error executing query: {str(e)}")
         raise
 
-def execute_many(cursor, query, data):
+def execute_many(cursor, query, data, page_size=1000):
     try:
-        cursor.executemany(query, data)
+        # executemany round-trips once per row; the extras helpers batch
+        # page_size rows per statement instead
+        if 'VALUES %s' in query:
+            extras.execute_values(cursor, query, data, page_size=page_size)
+        else:
+            extras.execute_batch(cursor, query, data, page_size=page_size)
     except Exception as e:
         logger.error(f"Error executing query with many parameters: {str(e)}")
         raise
 
+def copy_dataframe(conn, table, df, columns=None):
+    """Stream a DataFrame into a table via COPY FROM STDIN - PostgreSQL's
+    fastest bulk-load path, bypassing per-statement parsing entirely."""
+    if columns is None:
+        columns = list(df.columns)
+
+    buf = io.StringIO()
+    # Serialize exactly the columns named in the COPY target list, in the
+    # same order - otherwise a frame with extra or reordered columns would
+    # load silently misaligned
+    df.to_csv(buf, index=False, header=False, columns=columns)
+    buf.seek(0)
+
+    cursor = conn.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV",
+            buf
+        )
+    finally:
+        cursor.close()
+
 def execute_sql_file(conn, file_path):
     logger.info(f"Executing SQL file: {file_path}")
     
@@ -38,53 +175,52 @@ def execute_sql_file(conn, file_path):
 
         cursor = conn.cursor()
 
-        sql_content = re.sub(r'--.*?\n', '\n', sql_content)
-        sql_content = re.sub(r'/\*.*?\*/', '', sql_content, flags=re.DOTALL)
-
-        statements = []
-        statement_parts = []
-        in_string = False
-        string_delimiter = None
-        
-        for char in sql_content:
-            if char in ['"', "'"]:
-                if not in_string:
-                    in_string = True
-                    string_delimiter = char
-                elif char == string_delimiter:
-                    in_string = False
-            
-            statement_parts.append(char)
-            
-            if char == ';' and not in_string:
-                statements.append(''.join(statement_parts))
-                statement_parts = []
-
-        if statement_parts:
-            statements.append(''.join(statement_parts))
+        # sqlparse tokenizes the file in one pass and handles quoted and
+        # dollar-quoted semicolons, which the old per-character splitter
+        # broke on
+        statements = sqlparse.split(sqlparse.format(sql_content, strip_comments=True))
 
+        # Seed files interleave DDL with long runs of INSERTs; each run of
+        # consecutive INSERTs collapses into one multi-statement round trip
+        merged = []
+        insert_run = []
         for statement in statements:
             statement = statement.strip()
             if not statement:
                 continue
-                
+            if statement.split(None, 1)[0].upper() == 'INSERT':
+                insert_run.append(statement)
+                continue
+            if insert_run:
+                merged.append('; '.join(insert_run))
+                insert_run = []
+            merged.append(statement)
+        if insert_run:
+            merged.append('; '.join(insert_run))
+
+        # One transaction for the whole file - a savepoint per statement
+        # skips duplicates without giving up earlier work, and the single
+        # terminal commit turns N WAL flushes into one
+        for statement in merged:
+            cursor.execute("SAVEPOINT sql_file_stmt")
             try:
                 cursor.execute(statement)
-                conn.commit()
+                cursor.execute("RELEASE SAVEPOINT sql_file_stmt")
             except psycopg2.errors.DuplicateTable as e:
                 # Log but continue if table already exists
                 logger.warning(f"Table already exists: {str(e)}")
-                conn.rollback()
+                cursor.execute("ROLLBACK TO SAVEPOINT sql_file_stmt")
             except psycopg2.errors.DuplicateObject as e:
                 # Log but continue if object already exists
                 logger.warning(f"Object already exists: {str(e)}")
-                conn.rollback()
+                cursor.execute("ROLLBACK TO SAVEPOINT sql_file_stmt")
             except Exception as e:
                 logger.error(f"Error executing SQL statement: {str(e)}")
                 logger.error(f"Problematic SQL statement: {statement}")
                 conn.rollback()
                 raise
 
+        conn.commit()
         cursor.close()
         
         logger.info(f"SQL file executed successfully: {file_path}")
@@ -95,7 +231,12 @@ def execute_sql_file(conn, file_path):
 
 def close_connection(conn):
     try:
-        conn.close()
-        logger.info("Database connection closed")
+        conn_pool = _conn_owner.pop(conn, None)
+        if conn_pool is not None:
+            conn_pool.putconn(conn)
+            logger.info("Database connection returned to pool")
+        else:
+            conn.close()
+            logger.info("Database connection closed")
     except Exception as e:
         logger.error(f"Error closing database connection: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,16 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+def write_csv(df, file_path):
+    if pa is not None:
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), file_path)
+    else:
+        df.to_csv(file_path, index=False)